@@ -4252,6 +4252,7 @@ if __name__ == "__main__":
     job.add('--mismatches_column','5',kind='parameter')
     job.add('--output',outdir('reads_filtered_unique-mapped-genome_transcriptome.map'),kind='output')
     job.add('--tmp_dir',tmp_dir,kind='parameter',checksum='no')
+    job.add('--processes',options.processes,kind='parameter',checksum='no')
     job.run()
 
     # extract the names of the short reads which mapped on the transcriptome
@@ -48,57 +48,364 @@ import optparse
 import gc
 import shutil
 import tempfile
+import itertools
+import mmap
+import stat
+import multiprocessing
+import array
 
-def give_me_temp_filename(tmp_dir):
+# lazy zip() with Python 2 and Python 3
+izip = getattr(itertools,'izip',zip)
+
+# the read names are replaced in 'baza' by their hashes (a collision of two
+# 64-bit hashes is very unlikely and affects at most one read) only when
+# hash() is 64-bit, otherwise the collisions would be frequent and the read
+# names themselves are used (more memory but always right)
+if hasattr(sys,'hash_info'):
+    hash_64 = sys.hash_info.width >= 64
+else:
+    hash_64 = sys.maxint >= 2**63 - 1
+
+def read_name(rr):
+    return rr
+
+read_key = hash if hash_64 else read_name
+
+# buffer size used for writing the output files
+size_buffer_write = 2**23
+
+def give_me_temp_file(tmp_dir):
     if tmp_dir and (not os.path.isdir(tmp_dir)) and (not os.path.islink(tmp_dir)):
         os.makedirs(tmp_dir)
-    (ft,ft_name) = tempfile.mkstemp(dir = tmp_dir)
-    os.close(ft)
-    return ft_name
+    # the temporary files are used only when 'baza' has several parts, i.e.
+    # when the memory is already tight, and therefore they are kept on disk
+    return tempfile.TemporaryFile(mode = 'w+b', dir = tmp_dir)
+
+def is_not_worse(r, m):
+    # tells if the mismatches column 'r' of a mapping has no more than 'm'
+    # mismatches; the end of line does not change the number of mismatches
+    # and for 'm' zero it is enough to find the first one instead of counting
+    # all of them
+    return (r.count(b':') <= m) if m else (b':' not in r)
+
+def read_lazy_lines(fi, size_lines = 10**5):
+    # read lazily the lines of a file which is not mapped (e.g. a pipe or a
+    # temporary file) in small blocks of lines
+    while True:
+        lines = list(itertools.islice(fi,size_lines))
+        if not lines:
+            break
+        yield lines
+
+def give_me_blocks(mm, size_buffer = 10**8):
+    # split the mapped file in blocks of complete lines as (start, end)
+    size = len(mm)
+    pos = 0
+    while pos < size:
+        end = mm.find(b'\n', pos + size_buffer)
+        end = size if end == -1 else end + 1
+        yield (pos,end)
+        pos = end
+
+def read_block(fi, start, end):
+    # read the lines of a block of the file, as raw bytes, mapping only that
+    # block (the pages of the blocks already read do not stay mapped)
+    offset = start - start % mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap(fi.fileno(), end - offset, access = mmap.ACCESS_READ, offset = offset)
+    du = mm[start-offset:].splitlines(True)
+    mm.close()
+    return du
+
+def read_lines(a_file, size_buffer = 10**8):
+    # read the file in blocks of complete lines, as raw bytes, using mmap
+    fi = open(a_file,'rb',size_buffer_write)
+    st = os.fstat(fi.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        for lines in read_lazy_lines(fi):
+            yield lines
+    elif st.st_size:
+        mm = mmap.mmap(fi.fileno(), 0, access = mmap.ACCESS_READ)
+        blocks = list(give_me_blocks(mm,size_buffer))
+        mm.close()
+        for (start,end) in blocks:
+            yield read_block(fi,start,end)
+    fi.close()
 
-def giveRC(h,col):
-    return (h[0],h[col])
+def map_reads(a_file, size_buffer = 10**8):
+    # get all the mappings of each read as (read name, mappings)
+    last_read = None
+    last_lines = []
+    for lines in read_lines(a_file,size_buffer):
+        for line in lines:
+            rr = line[:line.find(b'\t')]
+            if last_read != rr:
+                if last_lines:
+                    if rr < last_read:
+                        raise ValueError("The input file '%s' is not sorted by read name!" % (a_file,))
+                    yield (last_read,last_lines)
+                last_read = rr
+                last_lines = [line]
+            else:
+                last_lines.append(line)
+    if last_lines:
+        yield (last_read,last_lines)
+
+def merge_sorted(map_1, map_2, column, output_filename):
+    # both MAP files are sorted by read name therefore they are scanned only
+    # once and in parallel
+    final = open(output_filename,'wb',size_buffer_write)
+    data = []
+    reads_1 = map_reads(map_1)
+    try:
+        (read_1,lines_1) = next(reads_1,(None,None))
+        for (rr,lines) in map_reads(map_2):
+            while read_1 is not None and read_1 < rr:
+                (read_1,lines_1) = next(reads_1,(None,None))
+            if read_1 == rr:
+                m_1 = lines_1[0].split(b'\t',column+1)[column].count(b':')
+                if not is_not_worse(lines[0].split(b'\t',column+1)[column],m_1):
+                    continue
+            data.extend(lines)
+            if len(data) > 10**6:
+                final.write(b''.join(data))
+                del data[:]
+    except ValueError:
+        # an input file is not sorted and the partial output is removed
+        final.close()
+        os.remove(output_filename)
+        raise
+    if data:
+        final.write(b''.join(data))
+    final.close()
 
-def map2dict(a_file, column, limit_counts_reads = 7*(10**7), size_buffer = 10**8):
-    # get read name and mismatches
-    fi = open(a_file,'r')
-    pack = None
+def parse_block(work):
+    # get the keys of the read names and the mismatches of the first mapping
+    # of each read found in the given block of the file (it may run in a
+    # separate process); only the block is mapped and it is parsed directly
+    # from the mapping without copying it or building the list of its lines
+    (a_file,start,end,column) = work
+    fi = open(a_file,'rb')
+    offset = start - start % mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap(fi.fileno(), end - offset, access = mmap.ACCESS_READ, offset = offset)
+    du = parse_buffer(mm,column,start-offset,end-offset)
+    mm.close()
+    fi.close()
+    return du
+
+def parse_buffer(buf, column, pos = 0, end = None):
+    # get the key of the read name (see 'read_key') and the mismatches of the
+    # first mapping of each read found in the lines of the buffer (bytes or
+    # mmap) between 'pos' and 'end'; the duplicate mappings are skipped using
+    # only the read name (all mappings of a read are consecutive) and only the
+    # kept lines are split up to the mismatches column (the end of line does
+    # not change the number of mismatches and an empty column gives zero); the
+    # hashes and the mismatches are given as compact arrays which are cheap to
+    # send back from a worker process (one byte is enough for the number of
+    # mismatches)
+    if end is None:
+        end = len(buf)
+    if not hash_64:
+        reads = []
+    elif array.array('l').itemsize >= 8:
+        reads = array.array('l')
+    else:
+        reads = array.array('q')
+    counts = array.array('B')
+    add_read = reads.append
+    add_count = counts.append
+    key = read_key
+    find = buf.find
     last_read = None
-    base = []
-    while True:
-        gc.disable()
-        du = fi.readlines(size_buffer)
-        gc.enable()
-        if not du:
-            break
-        gc.disable()
-        du = [giveRC(d.rstrip('\r\n').split('\t'),column) for d in du]
-        gc.enable()
-        di = []
-        for d in du:
-            if last_read != d[0]:
-                gc.disable()
-                di.append((d[0],0 if not d[1] else d[1].count(':')))
-                gc.enable()
-                last_read = d[0]
-        if di:
-            gc.disable()
-            base.extend(di)
-            gc.enable()
-            di = []
+    while pos < end:
+        eol = find(b'\n',pos,end)
+        if eol == -1:
+            eol = end
+        tab = find(b'\t',pos,eol)
+        rr = buf[pos:tab if tab != -1 else eol]
+        if last_read != rr:
+            last_read = rr
+            add_read(key(rr))
+            add_count(buf[pos:eol].split(b'\t',column+1)[column].count(b':'))
+        pos = eol + 1
+    return (reads,counts)
+
+def filter_block(lines, baza, column, keep, next_part, last_read = None, last_keep = None):
+    # the mappings of the reads which do not map worse than in 'baza' are
+    # given to 'keep', the mappings of the reads which are not found in 'baza'
+    # are given to 'next_part', and the rest are removed; it returns the last
+    # read and the decision taken for it (i.e. 'keep', 'next_part' or None)
+    # such that the decision is reused if its mappings continue in the next
+    # block (everything used in the loop is bound to local variables)
+    get_mismatches = baza.get
+    key = read_key
+    not_worse = is_not_worse
+    # all mappings of a read are consecutive therefore the decision is taken
+    # only for the first mapping of a read and it is reused for the rest; the
+    # read name is cut at the first tab without splitting or copying the rest
+    # of the line
+    for line in lines:
+        rr = line[:line.find(b'\t')]
+        # keep only the reads with their minimum mismatches
+        if last_read != rr:
+            last_read = rr
+            m = get_mismatches(key(rr))
+            if m is not None:
+                if not_worse(line.split(b'\t',column+1)[column],m):
+                    last_keep = keep
+                else:
+                    last_keep = None
+            else:
+                last_keep = next_part
+        if last_keep is not None:
+            last_keep(line)
+    return (last_read,last_keep)
+
+def map2dict(a_file, column, limit_counts_reads = 7*(10**7), size_buffer = 10**8, cpus = 1):
+    # get the keys of the read names (see 'read_key') and their mismatches
+    # (and a flag telling if it is the last part)
+    last_read = None
+    # a read found several times keeps its last mismatches (the mismatches
+    # are small integers which are shared by Python and cost only a pointer
+    # each)
+    base = {}
+    pool = None
+    fi = open(a_file,'rb',size_buffer_write)
+    st = os.fstat(fi.fileno())
+    if stat.S_ISREG(st.st_mode):
+        if cpus == 0:
+            cpus = multiprocessing.cpu_count()
+        if cpus > 1:
+            # all the workers together map about as much as one single block
+            size_buffer = max(size_buffer // cpus, 2**24)
+        blocks = []
+        if st.st_size:
+            mm = mmap.mmap(fi.fileno(), 0, access = mmap.ACCESS_READ)
+            blocks = [(a_file,start,end,column) for (start,end) in give_me_blocks(mm,size_buffer)]
+            mm.close()
+        # no parallelism for small files
+        cpus = max(1,min(cpus,len(blocks)))
+        if cpus > 1:
+            # only 'cpus' blocks are parsed at once and only their hashes and
+            # mismatches are sent back; the workers are forked from this process
+            # because they must compute the same hashes as this process (with
+            # Python 3 the hashes of the strings are randomized for each new
+            # process which is not forked)
+            context = getattr(multiprocessing,'get_context',None)
+            context = context('fork') if context else multiprocessing
+            pool = context.Pool(processes = cpus)
+            parsed = itertools.chain.from_iterable(pool.map(parse_block,blocks[k:k+cpus]) for k in range(0,len(blocks),cpus))
+        else:
+            parsed = (parse_block(block) for block in blocks)
+    else:
+        # it cannot be mapped (e.g. a pipe) and it is parsed as it is read
+        parsed = (parse_buffer(b''.join(lines),column) for lines in read_lazy_lines(fi))
+    # the next block is parsed in advance in order to know which is the last part
+    last = True
+    du = next(parsed,None)
+    while du is not None:
+        du_next = next(parsed,None)
+        (reads,counts) = du
+        # the first read of this block may continue the last read of the
+        # previous block
+        if reads and reads[0] == last_read:
+            del reads[0]
+            del counts[0]
+        if reads:
+            last_read = reads[-1]
+            base.update(izip(reads,counts))
+        reads = None
+        counts = None
+        du = du_next
         if len(base) > limit_counts_reads:
-            gc.disable()
-            base = dict(base)
-            gc.enable()
-            yield base
-            base = []
-    if base:
-        gc.disable()
-        base = dict(base)
-        gc.enable()
-        yield base
-        base = []
+            last = du is None
+            yield (base,last)
+            base = {}
+    if pool:
+        pool.close()
+        pool.join()
     fi.close()
+    # the last part is given also when it is empty if the previous one was
+    # not marked as the last one
+    if base or not last:
+        yield (base,True)
+        base = None
+
+def filter_map(map_1, map_2, output_filename, column, tmp_dir = None, cpus = 0, assume_sorted = False, verbose = False):
+    """
+    It removes the reads from 'map_2' which map worse (i.e. with more
+    mismatches in the given column) than in 'map_1' and writes the rest in
+    'output_filename'. With 'assume_sorted' it raises ValueError if an input
+    file is not sorted by read name (and no output file is left).
+    """
+    if assume_sorted:
+        if verbose:
+            print("Reading ... %s" % (map_2,))
+        merge_sorted(map_1,
+                     map_2,
+                     column,
+                     output_filename)
+        return
+
+    # genome
+    # 250,858,502 lines => ~8GB
+    # the reads which are not found in the current part of 'baza' are kept in
+    # a temporary file for the next part; when there is only one part (or for
+    # the last one) they go directly in the output and no temporary file is used
+    fin = None
+    spare = None
+    final = open(output_filename,'wb',size_buffer_write)
+    first_flag = True
+    data = []
+    data_final = []
+    for (baza,last) in map2dict(map_1,column,cpus = cpus):
+        if verbose:
+            print("Reading ... %s" % (map_2,))
+        first_flag = False
+        fout = None
+        data_next = data_final
+        if not last:
+            # the two temporary files are reused in turns
+            if spare is None:
+                fout = give_me_temp_file(tmp_dir)
+            else:
+                fout = spare
+                fout.seek(0)
+                fout.truncate()
+            data_next = data
+        # the decision taken for the last read seen is reused for all its
+        # mappings, also when they continue in the next block of lines
+        lastread = None
+        lastdata = None
+        if fin is None:
+            blocks = read_lines(map_2)
+        else:
+            fin.seek(0)
+            blocks = read_lazy_lines(fin)
+        for lines in blocks:
+            (lastread,lastdata) = filter_block(lines,
+                                               baza,
+                                               column,
+                                               data_final.append,
+                                               data_next.append,
+                                               lastread,
+                                               lastdata)
+            if data:
+                fout.write(b''.join(data))
+            if data_final:
+                final.write(b''.join(data_final))
+            del data[:]
+            del data_final[:]
+        spare = fin
+        fin = fout
+    for ft in (fin,spare):
+        if ft is not None:
+            ft.close()
+    if first_flag:
+        # no reads in '--input_map_1' therefore all reads are kept
+        fin = open(map_2,'rb')
+        shutil.copyfileobj(fin,final,size_buffer_write)
+        fin.close()
+    final.close()
 
 
 if __name__ == '__main__':
@@ -152,6 +459,19 @@ mismatches)."""
                   default = None,
                   help = "The directory which should be used as temporary directory. By default is the OS temporary directory.")
 
+    parser.add_option("-p", "--processes",
+                      action = "store",
+                      type = "int",
+                      dest = "processes",
+                      default = 0,
+                      help = """Number of parallel processes/CPUs to be used for reading '--input_map_1'. In case of value 0 then the program will use all the CPUs which are found. The default value is %default.""")
+
+    parser.add_option("--assume_sorted",
+                      action="store_true",
+                      dest="assume_sorted",
+                      default = False,
+                      help="""If specified then both input MAP files are assumed to be sorted by read name (e.g. using 'LC_ALL=C sort -t "$(printf \'\\t\')" -k1,1') and they are filtered in one single pass. By default the reads are expected to be in any order and '--input_map_2' might be read several times.""")
+
     (options,args) = parser.parse_args()
 
     # validate options
@@ -175,90 +495,24 @@ mismatches)."""
 
 
     # running
-    print "Starting..."
+    print("Starting...")
+    # the reads are kept in very large lists of objects without any reference
+    # cycles and therefore the cyclic garbage collector is not needed at all
+    # (the memory is still freed by the reference counting)
+    gc.disable()
     mc = options.mismatches_column - 1
 
-    # genome
-    # 250,858,502 lines => ~8GB
-    in1 = options.map_2_filename
-    ou1 = give_me_temp_filename(options.tmp_dir)
-    final = open(options.output_filename,'w')
-    first_flag = True
-    lastread = None
-    lastappended = False
-    lastfinal = False
-    for baza in map2dict(options.map_1_filename,mc):
-        print "Reading ...",options.map_2_filename
-        fin = open(in1,'r')
-        fout = open(ou1,'w')
-        while True:
-            gc.disable()
-            lines = fin.readlines(10**8)
-            gc.enable()
-            if not lines:
-                break
-            data = []
-            data_final = []
-            for line in lines:
-                gc.disable()
-                r = line.rstrip('\r\n').split('\t')
-                gc.enable()
-                rr = r[0]
-                # keep only the reads with their minimum mismatches
-                if lastread == rr:
-                    if not lastappended:
-                        continue
-                    elif lastfinal:
-                        data_final.append(line)
-                    else:
-                        data.append(line)
-                else:
-                    lastread = rr
-                    if baza.has_key(rr):
-                        m = 0 if not r[mc] else r[mc].count(':')
-                        if baza[rr] >= m:
-                            gc.disable()
-                            data_final.append(line)
-                            gc.enable()
-                            lastappended = True
-                            lastfinal = True
-                        else:
-                            lastappended = False
-                    else:
-                        gc.disable()
-                        data.append(line)
-                        gc.enable()
-                        lastappended = True
-                        lastfinal = False
-            if data:
-                fout.writelines(data)
-            if data_final:
-                final.writelines(data_final)
-            data = []
-            data_final = []
-        fin.close()
-        fout.close()
-        if first_flag:
-            first_flag = False
-        else:
-            os.remove(in1)
-        in1 = ou1
-        ou1 = give_me_temp_filename(options.tmp_dir)
-    os.remove(ou1)
-    fin = file(in1,'r')
-    while True:
-        gc.disable()
-        lines = fin.readlines(10**8)
-        gc.enable()
-        if not lines:
-            break
-        gc.disable()
-        final.writelines(lines)
-        gc.enable()
-    fin.close()
-    final.close()
-    if not first_flag:
-        os.remove(in1)
-
+    try:
+        filter_map(options.map_1_filename,
+                   options.map_2_filename,
+                   options.output_filename,
+                   mc,
+                   tmp_dir = options.tmp_dir,
+                   cpus = options.processes,
+                   assume_sorted = options.assume_sorted,
+                   verbose = True)
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % (e,))
+        sys.exit(1)
 
-    print "The end."
+    print("The end.")